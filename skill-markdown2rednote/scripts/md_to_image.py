@@ -6,14 +6,19 @@ Markdown to Image Converter
 """
 
 import re
+import io
 import os
 import sys
 import argparse
-from typing import List, Tuple, Dict
+import queue
+import threading
+from typing import List, Tuple, Dict, Iterable, Iterator, Callable
 from dataclasses import dataclass
+from functools import lru_cache
+from itertools import accumulate
+from bisect import bisect_right
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from PIL import Image, ImageDraw, ImageFont
-import markdown
-from markdown.extensions import fenced_code, tables
 
 
 @dataclass
@@ -63,134 +68,189 @@ class StyleConfig:
     font_regular: str = "上图东观体-常规.ttf"
     font_bold: str = "上图东观体-粗体.ttf"
 
+    # PNG 压缩级别 0-9：级别越低编码越快、文件越大，0 为不压缩
+    png_compress_level: int = 1
+
+
+# 预先测量字宽的字符：ASCII 可见字符
+_ADVANCE_SAMPLE_CHARS = ''.join(chr(c) for c in range(0x20, 0x7F))
+# 中日韩字符近似等宽，用一个探测字符的字宽代替
+_CJK_PROBE_CHAR = '一'
+_CJK_START = 0x2E80
+
+
+# 前后都不是换行符的单个换行符
+_SINGLE_NEWLINE_RE = re.compile(r'(?<=[^\n])\n(?=[^\n])')
+
+# 无序列表项、有序列表项
+_UL_RE = re.compile(r'^[*\-+]\s(.+)')
+_OL_RE = re.compile(r'^\d+\.\s(.+)')
+
+# 列表项前缀：参数为项目序号（从 0 开始）
+_LIST_PREFIXES = {
+    'list': lambda i: "• ",
+    'ordered_list': lambda i: f"{i+1}. ",
+}
+
+# 内联格式：***粗斜体***、**粗体**、__粗体__、*斜体*、_斜体_、`代码`、==高亮==
+_INLINE_RE = re.compile(
+    r'\*\*\*(.+?)\*\*\*|\*\*(.+?)\*\*|__(.+?)__'
+    r'|\*(?!\*)([^*]+)\*(?!\*)|_(?!_)([^_]+)_(?!_)|`([^`]+)`|==(.+?)==',
+    re.DOTALL
+)
+# 内联片段类型编号
+_SEG_NORMAL, _SEG_BOLD, _SEG_ITALIC, _SEG_BOLD_ITALIC, _SEG_CODE, _SEG_HIGHLIGHT = range(6)
+# 与 _INLINE_RE 各捕获组一一对应的片段类型
+_INLINE_TYPES = (_SEG_BOLD_ITALIC, _SEG_BOLD, _SEG_BOLD, _SEG_ITALIC, _SEG_ITALIC,
+                 _SEG_CODE, _SEG_HIGHLIGHT)
+# 内联格式标记字符，文本中都没有时可以跳过格式解析
+_INLINE_CHARS = frozenset('*_`=')
+
+
+@lru_cache(maxsize=64)
+def _cached_font(path: str, size: int) -> ImageFont.FreeTypeFont:
+    """加载 TrueType 字体（按路径和字号缓存，多次转换时复用）"""
+    return ImageFont.truetype(path, size)
+
+
+@lru_cache(maxsize=1)
+def _default_font() -> ImageFont.ImageFont:
+    """加载默认字体（每个进程只加载一次）"""
+    return ImageFont.load_default()
+
+
+@lru_cache(maxsize=100_000)
+def _measure_text(font: ImageFont.FreeTypeFont, text: str) -> Tuple[int, int]:
+    """测量文本尺寸（按字体和文本缓存，避免重复调用 FreeType）"""
+    bbox = font.getbbox(text)
+    return bbox[2] - bbox[0], bbox[3] - bbox[1]
+
+
+@lru_cache(maxsize=256)
+def _render_glyph_cached(text: str, font: ImageFont.FreeTypeFont) -> Tuple[Image.Image, Tuple[int, int]]:
+    """
+    将文本预先渲染为灰度遮罩（按字体和文本缓存），用于反复出现的列表前缀
+    返回 (遮罩, 相对绘制坐标的偏移)，绘制时用 draw.bitmap 按遮罩填色
+    """
+    left, top, right, bottom = font.getbbox(text)
+    mask = Image.new('L', (max(right - left, 1), max(bottom - top, 1)))
+    ImageDraw.Draw(mask).text((-left, -top), text, font=font, fill=255)
+    return mask, (left, top)
+
 
 class MarkdownParser:
     """Markdown 解析器"""
     
-    def __init__(self):
-        self.md = markdown.Markdown(extensions=['fenced_code', 'tables'])
-    
     def parse(self, md_content: str) -> List[Dict]:
         """
         解析 Markdown 内容为结构化数据
         返回元素列表，每个元素包含类型和内容
         """
-        elements = []
-        lines = md_content.split('\n')
+        return list(self.iter_parse(md_content))
+    
+    def iter_parse(self, md_content: str) -> Iterator[Dict]:
+        """
+        逐行流式解析 Markdown 内容，每完成一个元素就立即产出
+        state 记录当前未结束的块：code / quote / list / ordered_list / paragraph
+        """
+        state = None
+        buffer = []
+        language = ''
         
-        i = 0
-        while i < len(lines):
-            line = lines[i]
+        for line in io.StringIO(md_content):
+            line = line.rstrip('\n')
             stripped = line.strip()
             
+            # 代码块内：直到结束标记前的行原样保留
+            if state == 'code':
+                if stripped.startswith('```'):
+                    yield self._finish_block(state, buffer, language)
+                    state = None
+                else:
+                    buffer.append(line)
+                continue
+            
+            # 续接当前块
+            if state == 'quote' and stripped.startswith('>'):
+                buffer.append(stripped[1:].strip())
+                continue
+            if state == 'list':
+                match = _UL_RE.match(stripped)
+                if match:
+                    buffer.append(match.group(1))
+                    continue
+            if state == 'ordered_list':
+                match = _OL_RE.match(stripped)
+                if match:
+                    buffer.append(match.group(1))
+                    continue
+            if state == 'paragraph' and stripped:
+                buffer.append(line)
+                continue
+            
+            # 当前块结束，当前行作为新块的开始
+            if state is not None:
+                yield self._finish_block(state, buffer, language)
+                state = None
+            
             # 空行
             if not stripped:
-                i += 1
                 continue
             
             # 标题
             if stripped.startswith('# '):
-                elements.append({
-                    'type': 'h1',
-                    'content': stripped[2:]
-                })
-                i += 1
+                yield {'type': 'h1', 'content': stripped[2:]}
                 continue
             elif stripped.startswith('## '):
-                elements.append({
-                    'type': 'h2',
-                    'content': stripped[3:]
-                })
-                i += 1
+                yield {'type': 'h2', 'content': stripped[3:]}
                 continue
             elif stripped.startswith('### '):
-                elements.append({
-                    'type': 'h3',
-                    'content': stripped[4:]
-                })
-                i += 1
+                yield {'type': 'h3', 'content': stripped[4:]}
                 continue
             
             # 代码块
             if stripped.startswith('```'):
-                language = stripped[3:].strip()
-                code_lines = []
-                i += 1
-                while i < len(lines) and not lines[i].strip().startswith('```'):
-                    code_lines.append(lines[i])
-                    i += 1
-                elements.append({
-                    'type': 'code',
-                    'content': '\n'.join(code_lines),
-                    'language': language
-                })
-                i += 1
+                state, buffer, language = 'code', [], stripped[3:].strip()
                 continue
             
             # 引用块
             if stripped.startswith('>'):
-                quote_lines = []
-                while i < len(lines) and lines[i].strip().startswith('>'):
-                    quote_lines.append(lines[i].strip()[1:].strip())
-                    i += 1
-                elements.append({
-                    'type': 'quote',
-                    'content': '\n'.join(quote_lines)
-                })
+                state, buffer = 'quote', [stripped[1:].strip()]
                 continue
             
             # 列表
-            if re.match(r'^[\*\-\+]\s', stripped):
-                list_items = []
-                while i < len(lines):
-                    match = re.match(r'^[\*\-\+]\s(.+)', lines[i].strip())
-                    if match:
-                        list_items.append(match.group(1))
-                        i += 1
-                    else:
-                        break
-                elements.append({
-                    'type': 'list',
-                    'items': list_items
-                })
+            match = _UL_RE.match(stripped)
+            if match:
+                state, buffer = 'list', [match.group(1)]
                 continue
             
             # 有序列表
-            if re.match(r'^\d+\.\s', stripped):
-                list_items = []
-                while i < len(lines):
-                    match = re.match(r'^\d+\.\s(.+)', lines[i].strip())
-                    if match:
-                        list_items.append(match.group(1))
-                        i += 1
-                    else:
-                        break
-                elements.append({
-                    'type': 'ordered_list',
-                    'items': list_items
-                })
+            match = _OL_RE.match(stripped)
+            if match:
+                state, buffer = 'ordered_list', [match.group(1)]
                 continue
             
             # 分隔线
             if stripped == '---' or stripped == '***' or stripped == '___':
-                elements.append({'type': 'hr'})
-                i += 1
+                yield {'type': 'hr'}
                 continue
             
             # 普通段落（处理内联格式）
-            paragraph_lines = []
-            while i < len(lines) and lines[i].strip():
-                paragraph_lines.append(lines[i])
-                i += 1
-            
-            if paragraph_lines:
-                content = ' '.join(paragraph_lines)
-                elements.append({
-                    'type': 'paragraph',
-                    'content': content
-                })
+            state, buffer = 'paragraph', [line]
         
-        return elements
+        # 文件结束时收尾未结束的块（包括未闭合的代码块）
+        if state is not None:
+            yield self._finish_block(state, buffer, language)
+    
+    def _finish_block(self, state: str, buffer: List[str], language: str) -> Dict:
+        """将累积的行组装为元素"""
+        if state == 'code':
+            return {'type': 'code', 'content': '\n'.join(buffer), 'language': language}
+        elif state == 'quote':
+            return {'type': 'quote', 'content': '\n'.join(buffer)}
+        elif state in ('list', 'ordered_list'):
+            return {'type': state, 'items': buffer}
+        return {'type': 'paragraph', 'content': ' '.join(buffer)}
 
 
 class ImageRenderer:
@@ -199,186 +259,128 @@ class ImageRenderer:
     def __init__(self, style: StyleConfig = None):
         self.style = style or StyleConfig()
         self._load_fonts()
+        # 空闲画布池：(图片, ImageDraw)，页面写完后归还，供后续页面复用
+        self._canvas_pool = queue.SimpleQueue()
     
     def _load_fonts(self):
         """加载字体"""
         try:
-            self.font_title = ImageFont.truetype(self.style.font_bold, self.style.title_font_size)
-            self.font_h1 = ImageFont.truetype(self.style.font_bold, self.style.h1_font_size)
-            self.font_h2 = ImageFont.truetype(self.style.font_bold, self.style.h2_font_size)
-            self.font_h3 = ImageFont.truetype(self.style.font_bold, self.style.h3_font_size)
-            self.font_body = ImageFont.truetype(self.style.font_regular, self.style.body_font_size)
-            self.font_code = ImageFont.truetype(self.style.font_regular, self.style.code_font_size)
-            self.font_small = ImageFont.truetype(self.style.font_regular, self.style.small_font_size)
-            self.font_bold = ImageFont.truetype(self.style.font_bold, self.style.body_font_size)
+            self.font_title = _cached_font(self.style.font_bold, self.style.title_font_size)
+            self.font_h1 = _cached_font(self.style.font_bold, self.style.h1_font_size)
+            self.font_h2 = _cached_font(self.style.font_bold, self.style.h2_font_size)
+            self.font_h3 = _cached_font(self.style.font_bold, self.style.h3_font_size)
+            self.font_body = _cached_font(self.style.font_regular, self.style.body_font_size)
+            self.font_code = _cached_font(self.style.font_regular, self.style.code_font_size)
+            self.font_small = _cached_font(self.style.font_regular, self.style.small_font_size)
+            self.font_bold = _cached_font(self.style.font_bold, self.style.body_font_size)
         except Exception as e:
             print(f"警告: 字体加载失败，使用默认字体: {e}")
-            self.font_title = ImageFont.load_default()
-            self.font_h1 = ImageFont.load_default()
-            self.font_h2 = ImageFont.load_default()
-            self.font_h3 = ImageFont.load_default()
-            self.font_body = ImageFont.load_default()
-            self.font_code = ImageFont.load_default()
-            self.font_small = ImageFont.load_default()
-            self.font_bold = ImageFont.load_default()
-    
-    def _parse_inline_format(self, text: str) -> List[Dict]:
+            self.font_title = _default_font()
+            self.font_h1 = _default_font()
+            self.font_h2 = _default_font()
+            self.font_h3 = _default_font()
+            self.font_body = _default_font()
+            self.font_code = _default_font()
+            self.font_small = _default_font()
+            self.font_bold = _default_font()
+        self._build_advance_tables()
+    
+    def _build_advance_tables(self):
+        """预先计算各字体的字宽表，换行时用查表代替 FreeType 测量"""
+        self._adv = {}
+        self._cjk_adv = {}
+        for font in (self.font_title, self.font_h1, self.font_h2, self.font_h3,
+                     self.font_body, self.font_code, self.font_small, self.font_bold):
+            if font in self._adv:
+                continue
+            self._adv[font] = {ch: font.getlength(ch) for ch in _ADVANCE_SAMPLE_CHARS}
+            self._cjk_adv[font] = font.getlength(_CJK_PROBE_CHAR)
+    
+    def _parse_inline_format(self, text: str) -> List[Tuple[int, int, int]]:
         """
         解析内联格式：**粗体**、*斜体*、`代码`、==高亮==
-        返回带有格式信息的片段列表
+        返回片段列表，每个片段为 (起始位置, 结束位置, 类型)，位置指向原文本，不复制内容
         """
-        segments = []
-        i = 0
-        n = len(text)
-        
-        while i < n:
-            # 尝试匹配各种格式
-            matched = False
-            
-            # 匹配 ***粗斜体***
-            if i + 6 <= n and text[i:i+3] == '***':
-                end = text.find('***', i+3)
-                if end != -1:
-                    content = text[i+3:end]
-                    if content:
-                        segments.append({'type': 'bold_italic', 'content': content})
-                    i = end + 3
-                    matched = True
-            
-            # 匹配 **粗体**
-            if not matched and i + 4 <= n and text[i:i+2] == '**':
-                end = text.find('**', i+2)
-                if end != -1:
-                    content = text[i+2:end]
-                    if content:
-                        segments.append({'type': 'bold', 'content': content})
-                    i = end + 2
-                    matched = True
-            
-            # 匹配 *斜体*
-            if not matched and i + 2 <= n and text[i] == '*' and text[i:i+2] != '**':
-                end = text.find('*', i+1)
-                if end != -1 and text[end:end+2] != '**':
-                    content = text[i+1:end]
-                    if content:
-                        segments.append({'type': 'italic', 'content': content})
-                    i = end + 1
-                    matched = True
-            
-            # 匹配 `代码`
-            if not matched and text[i] == '`':
-                end = text.find('`', i+1)
-                if end != -1:
-                    content = text[i+1:end]
-                    if content:
-                        segments.append({'type': 'code', 'content': content})
-                    i = end + 1
-                    matched = True
-            
-            # 匹配 ==高亮==
-            if not matched and i + 4 <= n and text[i:i+2] == '==':
-                end = text.find('==', i+2)
-                if end != -1:
-                    content = text[i+2:end]
-                    if content:
-                        segments.append({'type': 'highlight', 'content': content})
-                    i = end + 2
-                    matched = True
-            
-            # 匹配 __粗体__
-            if not matched and i + 4 <= n and text[i:i+2] == '__':
-                end = text.find('__', i+2)
-                if end != -1:
-                    content = text[i+2:end]
-                    if content:
-                        segments.append({'type': 'bold', 'content': content})
-                    i = end + 2
-                    matched = True
-            
-            # 匹配 _斜体_
-            if not matched and text[i] == '_' and text[i:i+2] != '__':
-                end = text.find('_', i+1)
-                if end != -1 and text[end:end+2] != '__':
-                    content = text[i+1:end]
-                    if content:
-                        segments.append({'type': 'italic', 'content': content})
-                    i = end + 1
-                    matched = True
-            
-            if not matched:
-                # 普通文本，找到下一个特殊字符
-                next_special = n
-                for pos in range(i+1, n):
-                    if text[pos] in '*`_=':
-                        next_special = pos
-                        break
-                segments.append({'type': 'normal', 'content': text[i:next_special]})
-                i = next_special
-        
-        # 合并连续的普通文本
-        merged = []
-        for seg in segments:
-            if seg['content']:  # 只保留非空内容
-                if merged and seg['type'] == 'normal' and merged[-1]['type'] == 'normal':
-                    merged[-1]['content'] += seg['content']
-                else:
-                    merged.append(seg)
-        
-        return merged if merged else [{'type': 'normal', 'content': text}]
+        # 普通文本与格式片段交替产出且都非空，不会出现相邻的普通片段，无需再合并
+        spans = []
+        last_end = 0
+        
+        for match in _INLINE_RE.finditer(text):
+            # 两个格式之间的普通文本
+            if match.start() > last_end:
+                spans.append((last_end, match.start(), _SEG_NORMAL))
+            start, end = match.span(match.lastindex)
+            spans.append((start, end, _INLINE_TYPES[match.lastindex - 1]))
+            last_end = match.end()
+        
+        if last_end < len(text):
+            spans.append((last_end, len(text), _SEG_NORMAL))
+        
+        return spans if spans else [(0, len(text), _SEG_NORMAL)]
     
     def _get_text_size(self, text: str, font: ImageFont.FreeTypeFont) -> Tuple[int, int]:
         """获取文本尺寸"""
-        bbox = font.getbbox(text)
-        return bbox[2] - bbox[0], bbox[3] - bbox[1]
+        return _measure_text(font, text)
+    
+    def _get_char_widths(self, text: str, font: ImageFont.FreeTypeFont) -> List[float]:
+        """按字宽表查出每个字符的宽度（换行只需要水平宽度）"""
+        adv = self._adv[font]
+        cjk_adv = self._cjk_adv[font]
+        widths = []
+        for char in text:
+            char_width = adv.get(char)
+            if char_width is None:
+                # 表外字符：中日韩字符用探测字宽，其余测量一次后记入表中
+                char_width = cjk_adv if ord(char) >= _CJK_START else font.getlength(char)
+                adv[char] = char_width
+            widths.append(char_width)
+        return widths
+    
+    def _get_text_width(self, text: str, font: ImageFont.FreeTypeFont) -> float:
+        """按字宽表累加文本宽度"""
+        return sum(self._get_char_widths(text, font))
     
     def _wrap_text(self, text: str, font: ImageFont.FreeTypeFont, max_width: int) -> List[str]:
-        """文本自动换行"""
+        """
+        文本自动换行
+        对字宽做前缀和，每行用二分查找定位断行位置
+        """
         lines = []
-        current_line = ""
-        
-        for char in text:
-            test_line = current_line + char
-            width, _ = self._get_text_size(test_line, font)
-            
-            if width <= max_width:
-                current_line = test_line
-            else:
-                if current_line:
-                    lines.append(current_line)
-                current_line = char
-        
-        if current_line:
-            lines.append(current_line)
-        
-        return lines if lines else [text] if text else []
+        cumulative = list(accumulate(self._get_char_widths(text, font)))
+        start = 0
+        line_start_width = 0
+        n = len(text)
+
+        while start < n:
+            end = bisect_right(cumulative, line_start_width + max_width, start)
+            # 每行至少保留一个字符
+            end = max(end, start + 1)
+            lines.append(text[start:end])
+            line_start_width = cumulative[end - 1]
+            start = end
+
+        return lines
     
-    def _render_text_line(self, draw: ImageDraw.Draw, x: int, y: int, 
-                          segments: List[Dict], fonts: Dict, colors: Dict) -> int:
-        """渲染一行带有格式的文本"""
+    def _render_text_line(self, draw: ImageDraw.Draw, x: int, y: int, text: str,
+                          spans: List[Tuple[int, int, int]], fonts: Dict, colors: Dict) -> int:
+        """渲染一行带有格式的文本，spans 为该行在 text 中的片段"""
         current_x = x
         max_height = 0
         
-        for seg in segments:
-            seg_type = seg['type']
-            content = seg['content']
+        for start, end, seg_type in spans:
+            content = text[start:end]
             
-            if seg_type == 'bold':
-                font = fonts['bold']
-            elif seg_type == 'italic':
-                font = fonts['body']  # 简化处理
-            elif seg_type == 'bold_italic':
+            if seg_type == _SEG_BOLD or seg_type == _SEG_BOLD_ITALIC:
                 font = fonts['bold']
-            elif seg_type == 'code':
+            elif seg_type == _SEG_CODE:
                 font = fonts['code']
-            elif seg_type == 'highlight':
-                font = fonts['body']
             else:
-                font = fonts['body']
+                font = fonts['body']  # 斜体、高亮使用正文字体（简化处理）
             
             width, height = self._get_text_size(content, font)
             
             # 绘制高亮背景
-            if seg_type == 'highlight':
+            if seg_type == _SEG_HIGHLIGHT:
                 padding = 4
                 draw.rectangle(
                     [current_x - padding, y - 2, current_x + width + padding, y + height + 4],
@@ -386,7 +388,7 @@ class ImageRenderer:
                 )
             
             # 绘制代码背景
-            if seg_type == 'code':
+            if seg_type == _SEG_CODE:
                 padding = 4
                 draw.rectangle(
                     [current_x - padding, y - 2, current_x + width + padding, y + height + 4],
@@ -402,116 +404,130 @@ class ImageRenderer:
         
         return max_height
     
-    def _calculate_element_height(self, element: Dict, max_width: int) -> int:
-        """计算元素所需高度"""
+    def _layout_element(self, element: Dict, max_width: int) -> Tuple[int, List]:
+        """
+        计算元素排版：完成换行并返回 (所需高度, 换行结果)
+        换行结果在分页和渲染时共用，避免重复解析和换行
+        """
         if element['type'] == 'h1':
             lines = self._wrap_text(element['content'], self.font_h1, max_width)
-            return len(lines) * self.style.h1_line_spacing
+            return len(lines) * self.style.h1_line_spacing, lines
         elif element['type'] == 'h2':
             lines = self._wrap_text(element['content'], self.font_h2, max_width)
-            return len(lines) * self.style.h2_line_spacing
+            return len(lines) * self.style.h2_line_spacing, lines
         elif element['type'] == 'h3':
             lines = self._wrap_text(element['content'], self.font_h3, max_width)
-            return len(lines) * self.style.h3_line_spacing
+            return len(lines) * self.style.h3_line_spacing, lines
         elif element['type'] == 'paragraph':
-            segments = self._parse_inline_format(element['content'])
-            # 使用与渲染一致的换行方法
-            lines = self._wrap_formatted_text(segments, self.font_body, max_width)
-            return len(lines) * self.style.body_line_spacing + self.style.paragraph_spacing
+            lines = self._wrap_body_text(element['content'], max_width)
+            return len(lines) * self.style.body_line_spacing + self.style.paragraph_spacing, lines
         elif element['type'] == 'code':
             lines = element['content'].split('\n')
-            return len(lines) * self.style.code_line_spacing + 40
+            return len(lines) * self.style.code_line_spacing + 40, lines
         elif element['type'] == 'quote':
-            lines = self._wrap_text(element['content'], self.font_body, max_width - 40)
-            return len(lines) * self.style.body_line_spacing + 30
-        elif element['type'] == 'list':
-            height = 0
-            for item in element['items']:
-                lines = self._wrap_text(item, self.font_body, max_width - 40)
-                height += len(lines) * self.style.body_line_spacing + 10
-            return height + 10
-        elif element['type'] == 'ordered_list':
-            height = 0
-            for i, item in enumerate(element['items']):
-                prefix = f"{i+1}. "
-                lines = self._wrap_text(prefix + item, self.font_body, max_width - 40)
-                height += len(lines) * self.style.body_line_spacing + 10
-            return height + 10
+            # 与渲染时的引用块内容宽度一致
+            lines = self._wrap_body_text(element['content'], max_width - 50)
+            return len(lines) * self.style.body_line_spacing + 30, lines
+        elif element['type'] in ('list', 'ordered_list'):
+            item_lines = self._layout_list_items(element['items'], _LIST_PREFIXES[element['type']],
+                                                 max_width)
+            return self._list_height(item_lines), item_lines
         elif element['type'] == 'hr':
-            return 40
+            return 40, []
         
-        return 0
+        return 0, []
+    
+    def _layout_list_items(self, items: List[str], prefix_fn: Callable[[int], str],
+                           max_width: int) -> List[List]:
+        """对列表各项换行，prefix_fn 根据序号（从 0 开始）返回该项的前缀"""
+        return [self._wrap_body_text(item, max_width, prefix_fn(i))
+                for i, item in enumerate(items)]
+    
+    def _list_height(self, item_lines: List[List]) -> int:
+        """列表所需高度：每项之后和列表末尾各留 10 像素"""
+        return sum(len(lines) * self.style.body_line_spacing + 10 for lines in item_lines) + 10
     
-    def _wrap_formatted_text(self, segments: List[Dict], font: ImageFont.FreeTypeFont, 
-                             max_width: int) -> List[List[Dict]]:
+    def _wrap_body_text(self, text: str, max_width: int, prefix: str = '') -> List:
+        """
+        正文换行，prefix 作为普通文本加在最前面（如列表符号）
+        没有内联标记的文本直接按纯文本换行，返回字符串行；
+        否则解析格式后换行，每行为 (文本, 该行片段列表)
+        """
+        if _INLINE_CHARS.isdisjoint(text):
+            return self._wrap_text(prefix + text, self.font_body, max_width) or ['']
+        
+        # 前缀不含格式标记，直接拼接后一起解析
+        text = prefix + text
+        spans = self._parse_inline_format(text)
+        return [(text, line_spans)
+                for line_spans in self._wrap_formatted_text(text, spans, self.font_body, max_width)]
+    
+    def _wrap_formatted_text(self, text: str, spans: List[Tuple[int, int, int]],
+                             font: ImageFont.FreeTypeFont, max_width: int) -> List[List[Tuple[int, int, int]]]:
         """
         对带格式的文本进行自动换行
-        返回每行的片段列表
+        返回每行的片段列表，片段为 (起始位置, 结束位置, 类型)
         对于格式化片段（粗体、高亮等），尽量保持完整不拆分
         """
         lines = []
         current_line = []
         current_width = 0
         
-        # 判断是否为特殊格式片段
-        def is_formatted(seg_type):
-            return seg_type in ('bold', 'italic', 'bold_italic', 'highlight', 'code')
+        def append_span(start, end, seg_type):
+            # 与上一片段同类型且首尾相连时合并
+            if current_line and current_line[-1][2] == seg_type and current_line[-1][1] == start:
+                current_line[-1] = (current_line[-1][0], end, seg_type)
+            else:
+                current_line.append((start, end, seg_type))
         
-        for seg in segments:
-            seg_type = seg['type']
-            content = seg['content']
+        for seg_start, seg_end, seg_type in spans:
+            content = text[seg_start:seg_end]
             
             # 选择合适的字体
-            if seg_type == 'bold':
+            if seg_type == _SEG_BOLD:
                 seg_font = self.font_bold
-            elif seg_type == 'code':
+            elif seg_type == _SEG_CODE:
                 seg_font = self.font_code
             else:
                 seg_font = font
             
             # 先计算整个片段的宽度
-            seg_width, _ = self._get_text_size(content, seg_font)
+            seg_width = self._get_text_width(content, seg_font)
             
             # 如果整个片段可以放入当前行
             if current_width + seg_width <= max_width:
-                if current_line and current_line[-1]['type'] == seg_type:
-                    # 合并同类型片段
-                    current_line[-1]['content'] += content
-                else:
-                    current_line.append({'type': seg_type, 'content': content})
+                append_span(seg_start, seg_end, seg_type)
                 current_width += seg_width
             else:
                 # 片段太长，无法放入当前行
                 # 对于格式化片段，尽量保持完整，先换行再尝试放入
-                if is_formatted(seg_type) and seg_width <= max_width:
+                if seg_type != _SEG_NORMAL and seg_width <= max_width:
                     # 先结束当前行
                     if current_line:
                         lines.append(current_line)
                     # 在新行开始这个片段
-                    current_line = [{'type': seg_type, 'content': content}]
+                    current_line = [(seg_start, seg_end, seg_type)]
                     current_width = seg_width
                 else:
                     # 普通文本或者太长的格式化片段，需要拆分
-                    char_idx = 0
-                    while char_idx < len(content):
-                        char = content[char_idx]
-                        char_width, _ = self._get_text_size(char, seg_font)
-                        
-                        if current_width + char_width <= max_width:
-                            # 可以放入当前行
-                            if current_line and current_line[-1]['type'] == seg_type:
-                                current_line[-1]['content'] += char
-                            else:
-                                current_line.append({'type': seg_type, 'content': char})
-                            current_width += char_width
-                            char_idx += 1
-                        else:
-                            # 需要换行
+                    # 对字宽做前缀和，用二分查找确定每行能放下的字符数
+                    cumulative = list(accumulate(self._get_char_widths(content, seg_font)))
+                    start = 0
+                    start_width = 0
+                    while start < len(content):
+                        end = bisect_right(cumulative, start_width + max_width - current_width, start)
+                        if end == start:
+                            # 当前行放不下下一个字符，需要换行（新行至少放一个字符）
                             if current_line:
                                 lines.append(current_line)
-                            current_line = [{'type': seg_type, 'content': char}]
-                            current_width = char_width
-                            char_idx += 1
+                            current_line = []
+                            current_width = 0
+                            end = max(bisect_right(cumulative, start_width + max_width, start), start + 1)
+                        
+                        append_span(seg_start + start, seg_start + end, seg_type)
+                        current_width += cumulative[end - 1] - start_width
+                        start_width = cumulative[end - 1]
+                        start = end
         
         # 添加最后一行
         if current_line:
@@ -519,9 +535,9 @@ class ImageRenderer:
         
         return lines if lines else [[]]
     
-    def _render_element(self, draw: ImageDraw.Draw, element: Dict, 
+    def _render_element(self, draw: ImageDraw.Draw, element: Dict, lines: List,
                         x: int, y: int, max_width: int) -> int:
-        """渲染单个元素，返回渲染后的 Y 坐标"""
+        """渲染单个元素（使用 _layout_element 的换行结果），返回渲染后的 Y 坐标"""
         
         fonts = {
             'body': self.font_body,
@@ -529,55 +545,43 @@ class ImageRenderer:
             'code': self.font_code
         }
         colors = {
-            'normal': self.style.text_color,
-            'bold': self.style.text_color,
-            'italic': self.style.text_color,
-            'code': (200, 50, 80),
-            'highlight': self.style.highlight_text
+            _SEG_NORMAL: self.style.text_color,
+            _SEG_BOLD: self.style.text_color,
+            _SEG_ITALIC: self.style.text_color,
+            _SEG_CODE: (200, 50, 80),
+            _SEG_HIGHLIGHT: self.style.highlight_text
         }
         
         if element['type'] == 'h1':
-            lines = self._wrap_text(element['content'], self.font_h1, max_width)
             for line in lines:
                 draw.text((x, y), line, font=self.font_h1, fill=self.style.title_color)
                 y += self.style.h1_line_spacing
             return y + 20
         
         elif element['type'] == 'h2':
-            lines = self._wrap_text(element['content'], self.font_h2, max_width)
             for line in lines:
                 draw.text((x, y), line, font=self.font_h2, fill=self.style.title_color)
                 y += self.style.h2_line_spacing
             return y + 15
         
         elif element['type'] == 'h3':
-            lines = self._wrap_text(element['content'], self.font_h3, max_width)
             for line in lines:
                 draw.text((x, y), line, font=self.font_h3, fill=self.style.title_color)
                 y += self.style.h3_line_spacing
             return y + 10
         
         elif element['type'] == 'paragraph':
-            # 先解析内联格式
-            full_text = element['content']
-            segments = self._parse_inline_format(full_text)
-            # 然后进行带格式的换行
-            lines = self._wrap_formatted_text(segments, self.font_body, max_width)
-            
-            for line_segments in lines:
-                self._render_text_line(draw, x, y, line_segments, fonts, colors)
-                y += self.style.body_line_spacing
-            
+            y = self._render_body_lines(draw, x, y, lines, fonts, colors)
             return y + self.style.paragraph_spacing
         
         elif element['type'] == 'code':
             # 代码块背景
-            lines = element['content'].split('\n')
             block_height = len(lines) * self.style.code_line_spacing + 30
             draw.rectangle([x, y, x + max_width, y + block_height], 
                           fill=self.style.code_bg, outline=self.style.border_color)
             
-            # 渲染代码
+            # 渲染代码（逐行绘制：Pillow 的 multiline_text 内部同样逐行绘制，
+            # 还要额外拆分文本并测量每行宽度，并不更快）
             code_y = y + 15
             for line in lines:
                 draw.text((x + 15, code_y), line, font=self.font_code, 
@@ -589,62 +593,19 @@ class ImageRenderer:
         elif element['type'] == 'quote':
             # 引用块左边框
             quote_x = x + 15
-            quote_width = max_width - 30
             
-            # 解析内联格式并渲染
-            content = element['content']
-            segments = self._parse_inline_format(content)
-            lines = self._wrap_formatted_text(segments, self.font_body, quote_width - 20)
             quote_height = len(lines) * self.style.body_line_spacing + 20
             
             draw.rectangle([x, y, x + 6, y + quote_height], fill=(150, 150, 150))
             
-            quote_y = y + 10
-            for line_segments in lines:
-                self._render_text_line(draw, quote_x, quote_y, line_segments, fonts, colors)
-                quote_y += self.style.body_line_spacing
+            self._render_body_lines(draw, quote_x, y + 10, lines, fonts, colors)
             
             return y + quote_height + 20
         
-        elif element['type'] == 'list':
-            for item in element['items']:
-                bullet = "• "
-                item_text = item
-                
-                # 解析内联格式
-                segments = self._parse_inline_format(item_text)
-                # 添加 bullet 作为普通文本前缀
-                if segments and segments[0]['type'] == 'normal':
-                    segments[0]['content'] = bullet + segments[0]['content']
-                else:
-                    segments.insert(0, {'type': 'normal', 'content': bullet})
-                
-                lines = self._wrap_formatted_text(segments, self.font_body, max_width)
-                
-                for line_segments in lines:
-                    self._render_text_line(draw, x, y, line_segments, fonts, colors)
-                    y += self.style.body_line_spacing
-                y += 10
-            return y + 10
-        
-        elif element['type'] == 'ordered_list':
-            for i, item in enumerate(element['items']):
-                prefix = f"{i+1}. "
-                item_text = item
-                
-                # 解析内联格式
-                segments = self._parse_inline_format(item_text)
-                # 添加序号前缀
-                if segments and segments[0]['type'] == 'normal':
-                    segments[0]['content'] = prefix + segments[0]['content']
-                else:
-                    segments.insert(0, {'type': 'normal', 'content': prefix})
-                
-                lines = self._wrap_formatted_text(segments, self.font_body, max_width)
-                
-                for line_segments in lines:
-                    self._render_text_line(draw, x, y, line_segments, fonts, colors)
-                    y += self.style.body_line_spacing
+        elif element['type'] in ('list', 'ordered_list'):
+            prefix_fn = _LIST_PREFIXES[element['type']]
+            for i, item_lines in enumerate(lines):
+                y = self._render_list_item(draw, x, y, item_lines, prefix_fn(i), fonts, colors)
                 y += 10
             return y + 10
         
@@ -654,12 +615,52 @@ class ImageRenderer:
         
         return y
     
-    def render(self, elements: List[Dict], output_dir: str, base_filename: str) -> List[str]:
+    def _render_body_lines(self, draw: ImageDraw.Draw, x: int, y: int, lines: List,
+                           fonts: Dict, colors: Dict) -> int:
+        """逐行渲染 _wrap_body_text 的换行结果，返回渲染后的 Y 坐标"""
+        for line in lines:
+            if isinstance(line, str):
+                draw.text((x, y), line, font=self.font_body, fill=self.style.text_color)
+            else:
+                text, spans = line
+                self._render_text_line(draw, x, y, text, spans, fonts, colors)
+            y += self.style.body_line_spacing
+        return y
+    
+    def _render_list_item(self, draw: ImageDraw.Draw, x: int, y: int, item_lines: List,
+                          prefix: str, fonts: Dict, colors: Dict) -> int:
+        """
+        渲染一个列表项，返回渲染后的 Y 坐标
+        换行结果的首行以 prefix 开头，前缀使用缓存的遮罩绘制，不再重复栅格化
+        """
+        first_line = item_lines[0]
+        if isinstance(first_line, str):
+            rest = first_line[len(prefix):] if len(first_line) >= len(prefix) else None
+        else:
+            text, spans = first_line
+            if spans and spans[-1][1] >= len(prefix):
+                rest = (text, [(max(start, len(prefix)), end, seg_type)
+                               for start, end, seg_type in spans if end > len(prefix)])
+            else:
+                rest = None
+        
+        if rest is None:
+            # 首行放不下完整前缀（宽度极窄），按普通文本渲染
+            return self._render_body_lines(draw, x, y, item_lines, fonts, colors)
+        
+        mask, (dx, dy) = _render_glyph_cached(prefix, self.font_body)
+        draw.bitmap((x + dx, y + dy), mask, fill=self.style.text_color)
+        
+        prefix_width = self._get_text_width(prefix, self.font_body)
+        self._render_body_lines(draw, x + prefix_width, y, [rest], fonts, colors)
+        return self._render_body_lines(draw, x, y + self.style.body_line_spacing,
+                                       item_lines[1:], fonts, colors)
+    
+    def render(self, elements: Iterable[Dict], output_dir: str, base_filename: str) -> List[str]:
         """
         渲染元素为图片，自动分页
         返回生成的图片路径列表
         """
-        output_paths = []
         page_num = 1
         
         content_width = self.style.width - self.style.margin_left - self.style.margin_right
@@ -671,51 +672,100 @@ class ImageRenderer:
         safe_bottom_margin = self.style.margin_bottom + 20
         max_content_height = self.style.height - safe_bottom_margin
 
-        for element in elements:
-            elem_height = self._calculate_element_height(element, content_width)
+        # 一次完成所有元素的换行，分页和渲染共用结果
+        layout = [(element, *self._layout_element(element, content_width))
+                  for element in elements]
 
-            # 检查是否需要分页
-            if current_y + elem_height > max_content_height:
-                # 保存当前页
-                if page_elements:
-                    path = self._save_page(page_elements, output_dir, base_filename, page_num)
-                    output_paths.append(path)
-                    page_num += 1
+        # 页面绘制在主线程依次进行，PNG 编码交给线程池并行完成，
+        # 同时限制等待编码的页数，避免页面副本在内存中无限堆积
+        workers = os.cpu_count() or 1
+        pending = threading.BoundedSemaphore(workers + 2)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            save_futures = []
+            # 记录第一个保存失败的异常，绘制下一页前检查，出错时不再绘制后续页面
+            save_errors = []
+            
+            def record_error(future):
+                if future.exception() is not None:
+                    save_errors.append(future.exception())
+            
+            def submit_page(page_elements, page_num):
+                if save_errors:
+                    raise save_errors[0]
+                future = self._save_page(page_elements, output_dir, base_filename,
+                                         page_num, executor, pending)
+                future.add_done_callback(record_error)
+                save_futures.append(future)
+            
+            # 按顺序贪心装页：每页第一个元素都放不进上一页，
+            # 因此在保持元素顺序的前提下页数已是最少，无需再回填或重新平衡
+            for element, elem_height, lines in layout:
+                # 检查是否需要分页
+                if current_y + elem_height > max_content_height:
+                    # 保存当前页
+                    if page_elements:
+                        submit_page(page_elements, page_num)
+                        page_num += 1
 
-                # 开始新页
-                page_elements = [element]
-                current_y = self.style.margin_top + elem_height
-            else:
-                page_elements.append(element)
-                current_y += elem_height
-        
-        # 保存最后一页
-        if page_elements:
-            path = self._save_page(page_elements, output_dir, base_filename, page_num)
-            output_paths.append(path)
+                    # 开始新页
+                    page_elements = [(element, lines)]
+                    current_y = self.style.margin_top + elem_height
+                else:
+                    page_elements.append((element, lines))
+                    current_y += elem_height
+            
+            # 保存最后一页
+            if page_elements:
+                submit_page(page_elements, page_num)
+            
+            output_paths = [future.result() for future in save_futures]
         
         return output_paths
     
-    def _save_page(self, elements: List[Dict], output_dir: str, 
-                   base_filename: str, page_num: int) -> str:
-        """保存单页图片"""
-        # 创建图片
-        img = Image.new('RGB', (self.style.width, self.style.height), self.style.bg_color)
-        draw = ImageDraw.Draw(img)
+    def _save_page(self, elements: List[Tuple[Dict, List]], output_dir: str, 
+                   base_filename: str, page_num: int, executor: Executor,
+                   pending: threading.Semaphore) -> Future:
+        """
+        绘制并保存单页图片，elements 为 (元素, 换行结果) 列表
+        pending 限制同时等待编码的页数，名额用尽时阻塞直到有页面写完；
+        画布数量因此也不超过名额数
+        返回保存任务的 Future，结果为图片路径
+        """
+        pending.acquire()
+        
+        # 取一块空闲画布并清空，没有空闲画布时新建
+        try:
+            img, draw = self._canvas_pool.get_nowait()
+            img.paste(self.style.bg_color, (0, 0, self.style.width, self.style.height))
+        except queue.Empty:
+            img = Image.new('RGB', (self.style.width, self.style.height), self.style.bg_color)
+            draw = ImageDraw.Draw(img)
         
         # 渲染元素
         x = self.style.margin_left
         y = self.style.margin_top
         content_width = self.style.width - self.style.margin_left - self.style.margin_right
         
-        for element in elements:
-            y = self._render_element(draw, element, x, y, content_width)
+        for element, lines in elements:
+            y = self._render_element(draw, element, lines, x, y, content_width)
         
-        # 保存图片
+        # 保存图片：画布直接交给后台线程，写完后归还画布池并释放名额
         filename = f"{base_filename}_{page_num:03d}.png"
         filepath = os.path.join(output_dir, filename)
-        img.save(filepath, 'PNG', quality=95)
+        future = executor.submit(self._write_png, img, filepath,
+                                 self.style.png_compress_level)
+        
+        def release(_):
+            self._canvas_pool.put((img, draw))
+            pending.release()
         
+        future.add_done_callback(release)
+        return future
+    
+    @staticmethod
+    def _write_png(img: Image.Image, filepath: str, compress_level: int) -> str:
+        """编码并写出 PNG 文件（在线程池中执行）"""
+        img.save(filepath, 'PNG', compress_level=compress_level, optimize=False)
         return filepath
 
 
@@ -744,8 +794,7 @@ class MarkdownToImage:
             md_content = f.read()
 
         # 处理换行符：将单个换行符替换为两个，保留两个及以上的换行符
-        # 使用正则表达式匹配非空行后的单个换行符
-        md_content = re.sub(r'([^\n])\n([^\n])', r'\1\n\n\2', md_content)
+        md_content = _SINGLE_NEWLINE_RE.sub('\n\n', md_content)
 
         # 确定输出目录和文件名
         if output_dir is None:
@@ -758,9 +807,9 @@ class MarkdownToImage:
         os.makedirs(output_dir, exist_ok=True)
         
         # 解析 Markdown
-        elements = self.parser.parse(md_content)
+        elements = self.parser.iter_parse(md_content)
         
-        # 渲染为图片
+        # 渲染为图片（边解析边排版）
         output_paths = self.renderer.render(elements, output_dir, base_filename)
         
         return output_paths
@@ -774,11 +823,15 @@ def main():
     parser.add_argument('-n', '--name', help='输出文件基础名', default=None)
     parser.add_argument('-W', '--width', type=int, help='图片宽度', default=900)
     parser.add_argument('-H', '--height', type=int, help='单张图片高度', default=1600)
+    parser.add_argument('--fast', action='store_true',
+                        help='草稿模式：PNG 不压缩，输出更快但文件更大')
     
     args = parser.parse_args()
     
     # 创建样式配置
     style = StyleConfig(width=args.width, height=args.height)
+    if args.fast:
+        style.png_compress_level = 0
     
     # 创建转换器并转换
     converter = MarkdownToImage(style)